@@ -1,16 +1,44 @@
 # -*- coding: utf-8 -*-
 """Main module."""
+import time
 import pymongo
-from datetime import datetime
-from cerberus import Validator
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
+from cerberus import TypeDefinition, Validator
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import ConnectionFailure, PyMongoError
+from pymongo.results import UpdateResult
 
 
 class PayloadValidationError(Exception):
     """Raised when payload validation failis"""
 
 
+class GroupNotFoundError(KeyError):
+    """Raised when task group does not exist"""
+
+
+def raw_task_id(document):
+    """Convenience accessor for task `_id` of `RawBSONDocument`.
+
+    First access decodes top-level fields, payload stays raw bytes.
+    """
+    return document['_id']
+
+
+def raw_task_priority(document):
+    """Convenience accessor for task priority of `RawBSONDocument`"""
+    return document.get('priority', 0)
+
+
+class MongoValidator(Validator):
+    """Validator aware of mongodb `ObjectId` type"""
+
+    types_mapping = Validator.types_mapping.copy()
+    types_mapping['objectid'] = TypeDefinition('objectid', (ObjectId,), ())
+
+
 class MongodbConnector:
     """Connector to mongodb DATABASE"""
 
@@ -66,12 +94,18 @@ class BaseMongodbQueue:
         },
         'priority': {'type': 'integer', 'default': 0},
         'payload': {'type': 'dict', 'required': True},
+        'group_id': {
+            'type': 'objectid',
+            'nullable': True,
+            'required': False,
+        },
     }
 
     _indexes = [
         [('priority', -1)],
         [('created_at', 1)],
         [('finished_at', -1)],
+        [('group_id', 1)],
     ]
 
     _sort_by = [
@@ -79,10 +113,17 @@ class BaseMongodbQueue:
         ('created_at', 1),
     ]
 
+    # max number of documents touched by a single write of bulk operations
+    _batch_size = 1000
+
     @property
     def col(self):
         return self._conn[self._queue_name]
 
+    @property
+    def group_col(self):
+        return self._conn['{}_groups'.format(self._queue_name)]
+
     @property
     def sort_by(self):
         return self._sort_by
@@ -96,7 +137,7 @@ class BaseMongodbQueue:
         self._conn = self._db[dbname]
 
         self._payload_validator = Validator(self._payload_schema)
-        self._document_validator = Validator(self._queue_schema)
+        self._document_validator = MongoValidator(self._queue_schema)
 
     def put(self, payload, priority=0, selector={}):
         """Put task into profiles queue
@@ -166,15 +207,159 @@ class BaseMongodbQueue:
         res = self.col.bulk_write(ops)
         return res
 
-    def get(self, length, selector={}):
+    def put_group(self, payload_list, priority=0):
+        """Put list of tasks into the queue as a single group
+
+        :param payload_list: payloads to save into the queue
+        :param priority: the bigger the better
+        :returns: `_id` of the group document
+        """
+        payloads = []
+        for payload in payload_list:
+            payload_normalized = self._payload_validator.normalized(payload)
+            v = self._payload_validator.validate(payload)
+            if v is False:
+                raise PayloadValidationError(
+                    "Vaidation_errors: {}".format(
+                        self._payload_validator.errors))
+            payloads.append(payload_normalized)
+
+        created_at = datetime.utcnow()
+        group = self.group_col.insert_one({
+            'total': len(payloads),
+            'pending': len(payloads),
+            'created_at': created_at,
+            'finished_at': None,
+        })
+        group_id = group.inserted_id
+
+        if not payloads:
+            self._finish_groups([group_id])
+            return group_id
+
+        try:
+            self.col.insert_many([
+                {
+                    'payload': payload,
+                    'priority': priority,
+                    'created_at': created_at,
+                    'finished_at': None,
+                    'group_id': group_id,
+                }
+                for payload in payloads
+            ])
+        except PyMongoError:
+            # don't wait for tasks which were never inserted
+            self.group_col.update_one(
+                {'_id': group_id},
+                {'$set': {
+                    'total': self.col.count_documents(
+                        {'group_id': group_id}),
+                }},
+            )
+            self.recount_group(group_id)
+            raise
+
+        return group_id
+
+    def get_group(self, group_id):
+        """Return group document with pending counter
+
+        :param group_id: `_id` returned by `put_group`
+        :returns: group document or None
+        """
+        return self.group_col.find_one({'_id': group_id})
+
+    def recount_group(self, group_id):
+        """Reset group pending counter to the number of unfinished tasks.
+
+        Task writes and counter updates are separate writes, counter
+        becomes stale when process dies in between.
+
+        :param group_id: `_id` returned by `put_group`
+        :returns: group document or None
+        """
+        pending = self.col.count_documents(
+            {'group_id': group_id, 'finished_at': None})
+
+        update = {'$set': {'pending': pending}}
+        if pending:
+            update['$set']['finished_at'] = None
+        self.group_col.update_one({'_id': group_id}, update)
+
+        if not pending:
+            self._finish_groups([group_id])
+        return self.get_group(group_id)
+
+    def wait_group(self, group_id, timeout=None, poll_interval=1.0,
+                   recount_after=60.0):
+        """Block until all tasks of the group are done.
+
+        :param group_id: `_id` returned by `put_group`
+        :param timeout: seconds to wait, None to wait forever
+        :param poll_interval: seconds between group reads
+        :param recount_after: seconds without counter progress after
+        which counter is recounted from tasks, None to disable
+        :returns: finished group document or None on timeout
+        :raises: `GroupNotFoundError` if group does not exist
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        pending = None
+        progress_at = time.time()
+        while True:
+            group = self.get_group(group_id)
+            if group is None:
+                raise GroupNotFoundError(group_id)
+            if group['pending'] <= 0:
+                return group
+
+            now = time.time()
+            if group['pending'] != pending:
+                pending = group['pending']
+                progress_at = now
+            if recount_after is not None \
+                    and now - progress_at >= recount_after:
+                # counter update may be lost, see `recount_group`
+                group = self.recount_group(group_id)
+                if group['pending'] <= 0:
+                    return group
+                pending = group['pending']
+                progress_at = now
+
+            if deadline is not None and now >= deadline:
+                return None
+            time.sleep(poll_interval)
+
+    def on_group_done(self, group):
+        """Called when the last task of the group is finished.
+        Override in subclass to react on completion.
+
+        :param group: finished group document
+        """
+
+    def get(self, length, selector={}, raw=False, stream=False,
+            batch_size=0):
         """Return sequence of tasks to process.
 
         :param length: the length of the desired sequence
         :param selector: additional condition to select tasks from queue
-        :returns: list of document
+        :param raw: return `RawBSONDocument` instead of decoded dict
+        :param stream: return lazy cursor instead of list
+        :param batch_size: number of documents fetched per round trip,
+        0 means server default
+        :returns: list of document or cursor if `stream` is set
         """
-        documents = self.col.find(selector).sort(
-            self.sort_by).limit(length)
+        col = self.col
+        if raw:
+            col = col.with_options(
+                codec_options=col.codec_options.with_options(
+                    document_class=RawBSONDocument))
+
+        documents = col.find(selector).sort(
+            self.sort_by).limit(length).batch_size(batch_size)
+
+        if stream:
+            return documents
 
         # for large collections  col.count() after .limit()
         # takes few minutes to complete
@@ -185,16 +370,110 @@ class BaseMongodbQueue:
         return result
 
     def mark_done(self, selector):
-        result = self.col.update_one(
+        task = self.col.find_one_and_update(
             selector,
             {
                 '$set': {
                     'finished_at': datetime.utcnow(),
                 }
             },
-            upsert=False,
+            projection={'group_id': True, 'finished_at': True},
+            return_document=ReturnDocument.BEFORE,
         )
-        return result
+
+        if task is not None and task.get('finished_at') is None \
+                and task.get('group_id') is not None:
+            self._adjust_groups({task['group_id']: -1})
+
+        # keep `update_one` result for callers
+        n = 0 if task is None else 1
+        return UpdateResult(
+            {'n': n, 'nModified': n, 'ok': 1.0},
+            self.col.write_concern.acknowledged)
+
+    def requeue_many(self, selector, priority_inc=0):
+        """Return finished tasks back to the queue.
+
+        :param selector: condition to select tasks to requeue
+        :param priority_inc: value added to the priority of each task
+        :returns: number of requeued tasks
+        """
+        update = {'$set': {'finished_at': None}}
+        if priority_inc:
+            update['$inc'] = {'priority': priority_inc}
+
+        selector = {'$and': [selector, {'finished_at': {'$ne': None}}]}
+        modified = 0
+        for id_range in self._id_ranges(selector):
+            batch = {'$and': [selector, id_range]}
+            # requeued grouped tasks are pending again
+            modified += self._update_grouped(batch, update, 1)
+
+            result = self.col.update_many(batch, update, upsert=False)
+            modified += result.modified_count
+        return modified
+
+    def mark_done_many(self, ids):
+        """Mark tasks with given `_id`s as finished.
+
+        :param ids: sequence of task `_id`s
+        :returns: number of updated tasks
+        """
+        ids = list(ids)
+        modified = 0
+        for start in range(0, len(ids), self._batch_size):
+            selector = {
+                '_id': {'$in': ids[start:start + self._batch_size]},
+                'finished_at': None,
+            }
+            update = {
+                '$set': {
+                    'finished_at': datetime.utcnow(),
+                }
+            }
+
+            modified += self._update_grouped(selector, update, -1)
+
+            result = self.col.update_many(selector, update, upsert=False)
+            modified += result.modified_count
+        return modified
+
+    def delete_many(self, selector):
+        """Delete tasks matching selector.
+
+        :param selector: condition to select tasks to delete
+        :returns: number of deleted tasks
+        """
+        deleted = 0
+        for id_range in self._id_ranges(selector):
+            batch = {'$and': [selector, id_range]}
+
+            # deleted unfinished grouped tasks are no longer pending
+            unfinished = {'$and': [batch, {'finished_at': None}]}
+            counts = {}
+            for group_id, ids in self._tasks_by_group(unfinished).items():
+                result = self.col.delete_many(
+                    {'$and': [unfinished, {'_id': {'$in': ids}}]})
+                counts[group_id] = -result.deleted_count
+                deleted += result.deleted_count
+
+            result = self.col.delete_many(batch)
+            deleted += result.deleted_count
+            self._adjust_groups(counts)
+        return deleted
+
+    def reap_expired(self, ttl=timedelta(days=1)):
+        """Delete tasks and task groups finished more than `ttl` ago.
+
+        Intended to be called periodically to keep the queue small.
+
+        :param ttl: `timedelta`, how long to keep finished tasks
+        :returns: number of deleted tasks
+        """
+        selector = {'finished_at': {'$lt': datetime.utcnow() - ttl}}
+        deleted = self.delete_many(selector)
+        self.group_col.delete_many(selector)
+        return deleted
 
     def size(self):
         return self.col.count()
@@ -206,6 +485,111 @@ class BaseMongodbQueue:
             idx.append(i)
         return idx
 
+    def _id_ranges(self, selector):
+        """Split documents matching selector into `_id` ranges
+        of at most `_batch_size` documents each.
+
+        :param selector: condition to select tasks
+        :returns: generator of `_id` range conditions
+        """
+        last_id = None
+        while True:
+            condition = selector
+            if last_id is not None:
+                condition = {'$and': [selector, {'_id': {'$gt': last_id}}]}
+
+            ids = [doc['_id'] for doc in self.col.find(
+                condition, {'_id': True}).sort(
+                    '_id', 1).limit(self._batch_size)]
+            if not ids:
+                return
+
+            yield {'_id': {'$gte': ids[0], '$lte': ids[-1]}}
+            last_id = ids[-1]
+
+    def _tasks_by_group(self, selector):
+        """Collect `_id`s of grouped tasks matching selector
+
+        :returns: dict of group `_id` to list of task `_id`s
+        """
+        groups = {}
+        tasks = self.col.find(
+            {'$and': [selector, {'group_id': {'$exists': True}}]},
+            {'group_id': True},
+        )
+        for task in tasks:
+            groups.setdefault(task['group_id'], []).append(task['_id'])
+        return groups
+
+    def _update_grouped(self, selector, update, pending_inc):
+        """Update grouped tasks matching selector and move pending
+        counter of each group by `pending_inc` per updated task.
+
+        Selector has to exclude tasks which are already in the target
+        state, so `modified_count` is the number of state changes.
+
+        :returns: number of updated tasks
+        """
+        modified = 0
+        counts = {}
+        for group_id, ids in self._tasks_by_group(selector).items():
+            result = self.col.update_many(
+                {'$and': [selector, {'_id': {'$in': ids}}]},
+                update,
+                upsert=False,
+            )
+            counts[group_id] = pending_inc * result.modified_count
+            modified += result.modified_count
+
+        self._adjust_groups(counts)
+        return modified
+
+    def _adjust_groups(self, counts):
+        """Apply pending counter changes to groups in one bulk write
+
+        :param counts: dict of group `_id` to pending counter change
+        """
+        ops = []
+        for group_id, count in counts.items():
+            if count == 0:
+                continue
+            update = {'$inc': {'pending': count}}
+            if count > 0:
+                update['$set'] = {'finished_at': None}
+            ops.append(pymongo.UpdateOne({'_id': group_id}, update))
+
+        if not ops:
+            return
+
+        self.group_col.bulk_write(ops, ordered=False)
+        self._finish_groups(
+            [group_id for group_id, count in counts.items() if count < 0])
+
+    def _finish_groups(self, group_ids):
+        """Set `finished_at` of groups without pending tasks and
+        call `on_group_done` once per finished group.
+        """
+        groups = self.group_col.find({
+            '_id': {'$in': group_ids},
+            'pending': {'$lte': 0},
+            'finished_at': None,
+        })
+        finished = []
+        for group in groups:
+            group['finished_at'] = datetime.utcnow()
+            result = self.group_col.update_one(
+                {'_id': group['_id'], 'finished_at': None},
+                {'$set': {'finished_at': group['finished_at']}},
+            )
+            # concurrent caller may have finished the group already
+            if result.modified_count:
+                finished.append(group)
+
+        # callbacks run after all groups are finished, so failing
+        # callback does not leave other groups unfinished
+        for group in finished:
+            self.on_group_done(group)
+
     def _validate_payload(self, payload):
         return self._payload_validator.validate(payload)
 
@@ -3,13 +3,22 @@
 
 """Tests for `mongodb_queue` package."""
 
+from datetime import datetime, timedelta
+
 import pytest
 
 from click.testing import CliRunner
 
 import pymongo
+from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
 from mongodb_queue import cli
-from mongodb_queue.mongodb_queue import BaseMongodbQueue
+from mongodb_queue.mongodb_queue import (
+    BaseMongodbQueue,
+    GroupNotFoundError,
+    raw_task_id,
+    raw_task_priority,
+)
 
 
 TEST_DATABASE_NAME = 'test_mqueue'
@@ -25,6 +34,16 @@ class MongodbQueue(BaseMongodbQueue):
     }
 
 
+class GroupQueue(MongodbQueue):
+
+    def __init__(self, *args, **kwargs):
+        super(GroupQueue, self).__init__(*args, **kwargs)
+        self.done_groups = []
+
+    def on_group_done(self, group):
+        self.done_groups.append(group['_id'])
+
+
 @pytest.fixture(scope='function')
 def test_db():
     """Test that we're using testing database,
@@ -36,6 +55,7 @@ def test_db():
     assert conn.name == TEST_DATABASE_NAME
     yield db, conn
     conn[QUEUE_COLLECTION].drop()
+    conn['{}_groups'.format(QUEUE_COLLECTION)].drop()
 
 
 @pytest.fixture
@@ -253,6 +273,254 @@ def test_mongo_queue_put_bulk(test_db):
     assert q.size() == 4
 
 
+def test_mongodb_queue_bulk_state_transitions(test_db):
+    client, conn = test_db
+
+    q = MongodbQueue(client, TEST_DATABASE_NAME)
+    q._batch_size = 2
+
+    for key in range(5):
+        payload = {
+            'key': str(key),
+            'required_value': 'yes' if key % 2 == 0 else 'nope',
+        }
+        q.put(payload, priority=key)
+
+    ids = [t['_id'] for t in q.get(5)]
+    assert q.mark_done_many(ids) == 5
+    assert q.col.count({'finished_at': None}) == 0
+
+    requeued = q.requeue_many(
+        {'payload.required_value': 'yes'}, priority_inc=10)
+    assert requeued == 3
+    assert q.col.count({'finished_at': None}) == 3
+    assert q.col.count({'priority': {'$gte': 10}}) == 3
+
+    # unfinished tasks are left untouched
+    assert q.requeue_many(
+        {'payload.required_value': 'yes'}, priority_inc=10) == 0
+    assert q.col.count({'priority': {'$gte': 20}}) == 0
+
+    assert q.delete_many({'payload.required_value': 'yes'}) == 3
+    assert q.size() == 2
+
+
+def test_mongodb_queue_mark_done_many_finished(test_db):
+    client, conn = test_db
+
+    q = MongodbQueue(client, TEST_DATABASE_NAME)
+
+    for key in range(2):
+        q.put({'key': str(key), 'required_value': 'yes'})
+
+    tasks = q.get(2)
+    assert q.mark_done_many([tasks[0]['_id']]) == 1
+    finished_at = q.col.find_one({'_id': tasks[0]['_id']})['finished_at']
+
+    # already finished task is neither updated nor counted
+    assert q.mark_done_many([t['_id'] for t in tasks]) == 1
+    task = q.col.find_one({'_id': tasks[0]['_id']})
+    assert task['finished_at'] == finished_at
+
+
+def test_mongodb_queue_reap_expired(test_db):
+    client, conn = test_db
+
+    q = MongodbQueue(client, TEST_DATABASE_NAME)
+
+    for key in range(4):
+        q.put({'key': str(key), 'required_value': 'yes'})
+
+    tasks = q.get(4)
+    q.mark_done_many([t['_id'] for t in tasks[:3]])
+    q.col.update_one(
+        {'_id': tasks[0]['_id']},
+        {'$set': {'finished_at': datetime.utcnow() - timedelta(days=2)}})
+
+    assert q.reap_expired(ttl=timedelta(days=1)) == 1
+    assert q.size() == 3
+
+
+def test_mongodb_queue_get_raw_stream(test_db):
+    client, conn = test_db
+
+    q = MongodbQueue(client, TEST_DATABASE_NAME)
+
+    for key in range(5):
+        q.put({'key': str(key), 'required_value': 'yes'}, priority=key)
+
+    tasks = q.get(3, raw=True, stream=True, batch_size=2)
+    assert not isinstance(tasks, list)
+
+    tasks = list(tasks)
+    assert len(tasks) == 3
+
+    decoded = q.get(3)
+    for raw, doc in zip(tasks, decoded):
+        assert isinstance(raw, RawBSONDocument)
+        assert raw_task_id(raw) == doc['_id']
+        assert raw_task_priority(raw) == doc['priority']
+
+
+def test_mongodb_queue_put_group(test_db):
+    client, conn = test_db
+
+    q = GroupQueue(client, TEST_DATABASE_NAME)
+
+    payloads = [
+        {'key': str(key), 'required_value': 'yes'} for key in range(4)]
+    group_id = q.put_group(payloads, priority=3)
+
+    assert q.size() == 4
+    assert q.get_group(group_id)['pending'] == 4
+
+    tasks = q.get(4)
+    assert all(t['group_id'] == group_id for t in tasks)
+
+    result = q.mark_done({'_id': tasks[0]['_id']})
+    assert result.modified_count == 1
+    # finishing the same task twice does not change the counter
+    q.mark_done({'_id': tasks[0]['_id']})
+    assert q.get_group(group_id)['pending'] == 3
+    assert q.wait_group(group_id, timeout=0) is None
+
+    q.mark_done_many([t['_id'] for t in tasks[1:]])
+
+    group = q.wait_group(group_id, timeout=0)
+    assert group['pending'] == 0
+    assert group['finished_at'] is not None
+    assert q.done_groups == [group_id]
+
+
+def test_mongodb_queue_mark_done_group_selector(test_db):
+    client, conn = test_db
+
+    q = GroupQueue(client, TEST_DATABASE_NAME)
+
+    payloads = [
+        {'key': str(key), 'required_value': 'yes'} for key in range(3)]
+    group_id = q.put_group(payloads)
+
+    # selector matching several tasks finishes exactly one of them
+    result = q.mark_done({'group_id': group_id})
+    assert result.modified_count == 1
+    assert q.col.count({'finished_at': None}) == 2
+    assert q.get_group(group_id)['pending'] == 2
+
+
+def test_mongodb_queue_requeue_group_task(test_db):
+    client, conn = test_db
+
+    q = GroupQueue(client, TEST_DATABASE_NAME)
+
+    payloads = [
+        {'key': str(key), 'required_value': 'yes'} for key in range(2)]
+    group_id = q.put_group(payloads)
+
+    tasks = q.get(2)
+    q.mark_done({'_id': tasks[0]['_id']})
+    assert q.get_group(group_id)['pending'] == 1
+
+    assert q.requeue_many({'_id': tasks[0]['_id']}) == 1
+    assert q.get_group(group_id)['pending'] == 2
+
+    q.mark_done({'_id': tasks[0]['_id']})
+    assert q.get_group(group_id)['pending'] == 1
+    assert q.done_groups == []
+
+    q.mark_done({'_id': tasks[1]['_id']})
+    assert q.get_group(group_id)['pending'] == 0
+    assert q.done_groups == [group_id]
+
+    # requeue of finished group reopens it
+    q.requeue_many({'group_id': group_id})
+    group = q.get_group(group_id)
+    assert group['pending'] == 2
+    assert group['finished_at'] is None
+
+
+def test_mongodb_queue_delete_group_task(test_db):
+    client, conn = test_db
+
+    q = GroupQueue(client, TEST_DATABASE_NAME)
+
+    payloads = [
+        {'key': str(key), 'required_value': 'yes'} for key in range(3)]
+    group_id = q.put_group(payloads)
+
+    tasks = q.get(3)
+    q.mark_done({'_id': tasks[0]['_id']})
+
+    # finished task is already counted, unfinished one is not pending
+    assert q.delete_many({'_id': {'$in': [tasks[0]['_id'],
+                                          tasks[1]['_id']]}}) == 2
+    assert q.get_group(group_id)['pending'] == 1
+
+    q.mark_done({'_id': tasks[2]['_id']})
+    assert q.wait_group(group_id, timeout=0)['pending'] == 0
+    assert q.done_groups == [group_id]
+
+
+def test_mongodb_queue_put_empty_group(test_db):
+    client, conn = test_db
+
+    q = GroupQueue(client, TEST_DATABASE_NAME)
+
+    group_id = q.put_group([])
+
+    group = q.wait_group(group_id, timeout=0)
+    assert group['pending'] == 0
+    assert group['finished_at'] is not None
+    assert q.done_groups == [group_id]
+
+
+def test_mongodb_queue_recount_group(test_db):
+    client, conn = test_db
+
+    q = GroupQueue(client, TEST_DATABASE_NAME)
+
+    payloads = [
+        {'key': str(key), 'required_value': 'yes'} for key in range(2)]
+    group_id = q.put_group(payloads)
+
+    # task finished without counter update, e.g. process died
+    q.col.update_many(
+        {'group_id': group_id}, {'$set': {'finished_at': datetime.utcnow()}})
+    assert q.get_group(group_id)['pending'] == 2
+
+    group = q.wait_group(group_id, timeout=0, recount_after=0)
+    assert group['pending'] == 0
+    assert group['finished_at'] is not None
+    assert q.done_groups == [group_id]
+
+
+def test_mongodb_queue_wait_unknown_group(test_db):
+    client, conn = test_db
+
+    q = GroupQueue(client, TEST_DATABASE_NAME)
+
+    with pytest.raises(GroupNotFoundError):
+        q.wait_group(ObjectId(), timeout=0)
+
+
+def test_mongodb_queue_reap_expired_groups(test_db):
+    client, conn = test_db
+
+    q = GroupQueue(client, TEST_DATABASE_NAME)
+
+    group_id = q.put_group([{'key': '1', 'required_value': 'yes'}])
+    q.mark_done({'group_id': group_id})
+    task = q.get(1)[0]
+    task.pop('_id')
+    assert q._validate_document(task) is True
+
+    q.group_col.update_one(
+        {'_id': group_id},
+        {'$set': {'finished_at': datetime.utcnow() - timedelta(days=2)}})
+    q.reap_expired(ttl=timedelta(days=1))
+    assert q.get_group(group_id) is None
+
+
 def test_command_line_interface():
     """Test the CLI."""
     runner = CliRunner()